@@ -2,8 +2,14 @@
 import numpy as np
 import ipopt
 from copy import deepcopy
+from scipy.linalg import cho_factor, cho_solve
 from limetr import utils
 
+from limetr._kernels import use_numba
+
+if use_numba:
+    from limetr._kernels import _g_gamma_kernel, _trim_obj_grad_kernel
+
 
 class LimeTr:
     def __init__(self, n, k_beta, k_gamma, Y, F, JF, Z,
@@ -59,15 +65,26 @@ class LimeTr:
         self.idx_gamma = slice(self.k_beta, self.k_beta + self.k_gamma)
         self.idx_delta = slice(self.k_beta + self.k_gamma, self.k)
         self.idx_split = np.cumsum(np.insert(n, 0, 0))[:-1]
+        self.group_slices = [slice(s, s + n_i)
+                             for s, n_i in zip(self.idx_split, self.n)]
+        # contiguous int64 offsets, lengths and ends of the groups, in
+        # the exact types the njit signatures declare
+        self.offs = np.ascontiguousarray(self.idx_split, dtype=np.int64)
+        self.lens = np.ascontiguousarray(self.n, dtype=np.int64)
+        self.end = self.offs + self.lens
+        # equal-size groups let the varmat use batched lapack solves
+        self._equal_groups = bool(np.all(self.n == self.n[0]))
 
         # pass in the data
         self.Y = Y
-        self.F = F
-        self.JF = JF
-        self.Z = Z
+        self.F = self._memoizeOnBeta(F)
+        self.JF = self._memoizeOnBeta(JF)
+        self.Z = np.asfortranarray(Z)
+        self.Z2 = self.Z**2
         self.S = S
         if self.std_flag == 0:
             self.V = S**2
+            self._log_V = np.log(self.V)
 
         # pass in the priors
         self.use_constraints = (C is not None)
@@ -209,6 +226,24 @@ class LimeTr:
         self.num_outliers = self.N - self.num_inliers
         self.w = np.repeat(self.num_inliers/self.N, self.N)
 
+        # cache for the trimming-scaled data, refreshed when w changes
+        self._w_ver = 0
+        self._trim_cache = {'w_ver': -1}
+        self._trim_params = {}
+
+        # ipopt evaluates objective and gradient back to back at the
+        # same point, so keep the last factored varmat around
+        self._x_cache = {}
+
+        # reusable output buffer for the gradient
+        self._g_buf = np.empty(self.k_total)
+
+        # scratch buffers for the per-call trimming rescaling
+        if self.use_trimming:
+            self._sqrt_w = np.empty(self.N)
+            self._Fw_buf = np.empty(self.N)
+            self._JFw_buf = np.empty((self.N, self.k_beta))
+
         if self.certain_inlier_id is not None:
             self.certain_inlier_id = np.unique(self.certain_inlier_id)
             self.active_trimming_id = np.array(
@@ -229,11 +264,15 @@ class LimeTr:
         self.check()
 
     def check(self):
+        if not __debug__:
+            # python -O skips the input scan entirely
+            return
+
         assert self.Y.shape == (self.N,)
         assert self.Z.shape == (self.N, self.k_gamma)
         if self.S is not None:
             assert self.S.shape == (self.N,)
-            assert np.all(self.S > 0.0)
+            assert self.S.min() > 0.0
 
         if self.use_constraints:
             assert self.c.shape == (2, self.num_constraints)
@@ -262,6 +301,48 @@ class LimeTr:
         if self.k > self.N:
             print('Warning: information insufficient!')
 
+    @staticmethod
+    def _memoizeOnBeta(fun):
+        """
+        wrap a user callable with a one-slot memo keyed on the bytes of
+        its argument: objective and gradient evaluate F and JF at the
+        same beta within one ipopt iterate, and the user functions can
+        be arbitrarily expensive
+        """
+        memo = {}
+
+        def wrapped(beta):
+            key = (beta.dtype.str, beta.tobytes())
+            if memo.get('key') != key:
+                memo['key'] = key
+                memo['val'] = fun(beta)
+
+            return memo['val']
+
+        return wrapped
+
+    def _updateTrimCache(self):
+        """
+        return the trimming-scaled copies of the data, recomputing them
+        only when the trimming weights have changed
+        """
+        if self._trim_cache['w_ver'] != self._w_ver:
+            sqrt_w = np.sqrt(self.w, out=self._sqrt_w)
+            # reshape on demand: storing the (N, 1) view as a second
+            # attribute would sever it from the buffer under deepcopy
+            sqrt_W = sqrt_w.reshape(self.N, 1)
+            self._trim_cache = {
+                'w_ver': self._w_ver,
+                'sqrt_w': sqrt_w,
+                'sqrt_W': sqrt_W,
+                'Y': self.Y*sqrt_w,
+                'Z': np.asfortranarray(self.Z*sqrt_W)
+                }
+            if self.std_flag == 0:
+                self._trim_cache['V'] = np.exp(self.w*self._log_V)
+
+        return self._trim_cache
+
     def objective(self, x, use_ad=False):
         # unpack variable
         beta = x[self.idx_beta]
@@ -272,17 +353,21 @@ class LimeTr:
 
         # trimming option
         if self.use_trimming:
-            sqrt_w = np.sqrt(self.w)
-            sqrt_W = sqrt_w.reshape(self.N, 1)
-            F_beta = self.F(beta)*sqrt_w
-            Y = self.Y*sqrt_w
-            Z = self.Z*sqrt_W
+            cache = self._updateTrimCache()
+            sqrt_w = cache['sqrt_w']
+            F_beta = self.F(beta)
+            if np.iscomplexobj(F_beta):
+                F_beta = F_beta*sqrt_w
+            else:
+                F_beta = np.multiply(F_beta, sqrt_w, out=self._Fw_buf)
+            Y = cache['Y']
+            Z = cache['Z']
             if self.std_flag == 0:
-                V = self.V**self.w
+                V = cache['V']
             elif self.std_flag == 1:
-                V = np.repeat(delta[0], self.N)**self.w
+                V = np.exp(self.w*np.log(delta[0]))
             elif self.std_flag == 2:
-                V = np.repeat(delta, self.n)**self.w
+                V = np.exp(self.w*np.repeat(np.log(delta), self.n))
         else:
             F_beta = self.F(beta)
             Y = self.Y
@@ -296,7 +381,14 @@ class LimeTr:
 
         # residual and variance
         R = Y - F_beta
-        D = utils.VarMat(V, Z, gamma, self.n)
+        D = utils.VarMat(V, Z, gamma, self.n,
+                         equal_groups=self._equal_groups)
+
+        if not use_ad:
+            # x reflects the gamma clamp above, so gradient(x) lands on
+            # the same key and reuses the factorization
+            self._x_cache = {'key': (x.tobytes(), self._w_ver),
+                             'D': D, 'R': R}
 
         val = 0.5*self.N*np.log(2.0*np.pi)
 
@@ -304,20 +396,37 @@ class LimeTr:
             # should only use when testing
             varmat = D
             D = varmat.varMat()
-            inv_D = varmat.invVarMat()
 
-            val += 0.5*np.log(np.linalg.det(D))
-            val += 0.5*R.dot(inv_D.dot(R))
+            if np.iscomplexobj(D):
+                # complex-step perturbations make D complex symmetric,
+                # which the lapack cholesky cannot factor
+                val += 0.5*np.log(np.linalg.det(D))
+                val += 0.5*R.dot(varmat.invVarMat().dot(R))
+            else:
+                c_factor = cho_factor(D, lower=True, overwrite_a=True)
+                val += np.sum(np.log(np.diag(c_factor[0])))
+                val += 0.5*R.dot(cho_solve(c_factor, R))
         else:
             val += 0.5*D.logDet()
             val += 0.5*R.dot(D.invDot(R))
 
         # add gpriors
+        val += self._objectivePriors(x)
+
+        return val
+
+    def _objectivePriors(self, x):
+        """
+        return the objective contribution from the priors
+        """
+        val = 0.0
         if self.use_regularizer:
-            val += 0.5*self.hw.dot((self.H(x) - self.hm)**2)
+            r = self.H(x) - self.hm
+            val += 0.5*np.einsum('i,i,i->', r, r, self.hw)
 
         if self.use_gprior:
-            val += 0.5*self.gw.dot((x - self.gm)**2)
+            r = x - self.gm
+            val += 0.5*np.einsum('i,i,i->', r, r, self.gw)
 
         if self.use_lprior:
             val += self.lw.dot(x[self.k:])
@@ -327,14 +436,7 @@ class LimeTr:
     def gradient(self, x, use_ad=False, eps=1e-12):
         if use_ad:
             # should only use when testing
-            g = np.zeros(self.k_total)
-            z = x + 0j
-            for i in range(self.k_total):
-                z[i] += eps*1j
-                g[i] = self.objective(z, use_ad=use_ad).imag/eps
-                z[i] -= eps*1j
-
-            return g
+            return self._gradientAD(x, eps=eps)
 
         # unpack variable
         beta = x[self.idx_beta]
@@ -344,63 +446,93 @@ class LimeTr:
         gamma[gamma <= 0.0] = 0.0
 
         # trimming option
+        hit = self._x_cache.get('key') == (x.tobytes(), self._w_ver)
+
         if self.use_trimming:
-            sqrt_w = np.sqrt(self.w)
-            sqrt_W = sqrt_w.reshape(self.N, 1)
-            F_beta = self.F(beta)*sqrt_w
-            JF_beta = self.JF(beta)*sqrt_W
-            Y = self.Y*sqrt_w
-            Z = self.Z*sqrt_W
-            if self.std_flag == 0:
-                V = self.V**self.w
-            elif self.std_flag == 1:
-                V = np.repeat(delta[0], self.N)**self.w
-            elif self.std_flag == 2:
-                V = np.repeat(delta, self.n)**self.w
+            cache = self._updateTrimCache()
+            sqrt_w = cache['sqrt_w']
+            JF_beta = np.multiply(self.JF(beta), cache['sqrt_W'],
+                                  out=self._JFw_buf)
+            Y = cache['Y']
+            Z = cache['Z']
+            if not hit:
+                F_beta = np.multiply(self.F(beta), sqrt_w,
+                                     out=self._Fw_buf)
+                if self.std_flag == 0:
+                    V = cache['V']
+                elif self.std_flag == 1:
+                    V = np.exp(self.w*np.log(delta[0]))
+                elif self.std_flag == 2:
+                    V = np.exp(self.w*np.repeat(np.log(delta), self.n))
         else:
-            F_beta = self.F(beta)
             JF_beta = self.JF(beta)
             Y = self.Y
             Z = self.Z
-            if self.std_flag == 0:
-                V = self.V
-            elif self.std_flag == 1:
-                V = np.repeat(delta[0], self.N)
-            elif self.std_flag == 2:
-                V = np.repeat(delta, self.n)
-
-        # residual and variance
-        R = Y - F_beta
-        D = utils.VarMat(V, Z, gamma, self.n)
+            if not hit:
+                F_beta = self.F(beta)
+                if self.std_flag == 0:
+                    V = self.V
+                elif self.std_flag == 1:
+                    V = np.repeat(delta[0], self.N)
+                elif self.std_flag == 2:
+                    V = np.repeat(delta, self.n)
+
+        # residual and variance, reused from the objective call at the
+        # same point when possible
+        if hit:
+            R = self._x_cache['R']
+            D = self._x_cache['D']
+        else:
+            R = Y - F_beta
+            D = utils.VarMat(V, Z, gamma, self.n,
+                             equal_groups=self._equal_groups)
+
+        # write the blocks into the preallocated buffer
+        g = self._g_buf
+
+        # one batched solve for the residual and the random effect
+        # covariates, reusing the factorization across both blocks
+        rhs = np.empty((self.N, 1 + self.k_gamma))
+        rhs[:, 0] = R
+        rhs[:, 1:] = Z
+        sol = D.invDot(rhs)
+        DR = sol[:, 0]
+        DZ = sol[:, 1:]
 
         # gradient for beta
-        DR = D.invDot(R)
-        g_beta = -JF_beta.T.dot(DR)
+        g[self.idx_beta] = -JF_beta.T.dot(DR)
 
         # gradient for gamma
-        DZ = D.invDot(Z)
-        g_gamma = 0.5*np.sum(Z*DZ, axis=0) -\
-            0.5*np.sum(
-                np.add.reduceat(DZ.T*R, self.idx_split, axis=1)**2,
-                axis=1)
+        if use_numba:
+            g[self.idx_gamma] = _g_gamma_kernel(
+                np.asfortranarray(Z, dtype=np.float64),
+                np.asfortranarray(DZ, dtype=np.float64),
+                np.ascontiguousarray(R, dtype=np.float64),
+                self.offs, self.lens)
+        else:
+            g_gamma = 0.5*np.einsum('ij,ij->j', Z, DZ)
+            for sl in self.group_slices:
+                u = DZ[sl].T.dot(R[sl])
+                g_gamma -= 0.5*u*u
+            g[self.idx_gamma] = g_gamma
 
         # gradient for delta
-        if self.std_flag == 0:
-            g_delta = np.array([])
-        elif self.std_flag == 1:
+        if self.std_flag == 1:
             d = -DR**2 + D.invDiag()
             if self.use_trimming:
                 v = np.repeat(delta[0], self.N)
                 d *= self.w*(v**(self.w - 1.0))
-            g_delta = 0.5*np.array([np.sum(d)])
+            g[self.idx_delta] = 0.5*np.sum(d)
         elif self.std_flag == 2:
             d = -DR**2 + D.invDiag()
             if self.use_trimming:
                 v = np.repeat(delta, self.n)
                 d *= self.w*(v**(self.w - 1.0))
-            g_delta = 0.5*(np.add.reduceat(d, self.idx_split))
+            g[self.idx_delta] = 0.5*(np.add.reduceat(d, self.idx_split))
 
-        g = np.hstack((g_beta, g_gamma, g_delta))
+        # gradient from the lprior abs variables
+        if self.use_lprior:
+            g[self.k:] = self.lw
 
         # add gradient from the regularizer
         if self.use_regularizer:
@@ -410,21 +542,143 @@ class LimeTr:
         if self.use_gprior:
             g += (x - self.gm)*self.gw
 
-        # add gradient from the lprior
-        if self.use_lprior:
-            g = np.hstack((g, self.lw))
+        return g
+
+    def _gradientAD(self, x, eps=1e-12):
+        """
+        complex-step gradient, reusing the factorization of the
+        unperturbed varmat: beta perturbations leave D unchanged and
+        gamma perturbations are rank-one updates of D, so only the
+        delta components rebuild the dense matrix
+        """
+        # unpack variable
+        beta = x[self.idx_beta]
+        gamma = x[self.idx_gamma]
+        delta = x[self.idx_delta]
+
+        gamma[gamma <= 0.0] = 0.0
+
+        # trimming option
+        if self.use_trimming:
+            cache = self._updateTrimCache()
+            sqrt_w = cache['sqrt_w']
+            F_beta = self.F(beta)*sqrt_w
+            Y = cache['Y']
+            Z = cache['Z']
+            if self.std_flag == 0:
+                V = cache['V']
+            elif self.std_flag == 1:
+                V = np.exp(self.w*np.log(delta[0]))
+            elif self.std_flag == 2:
+                V = np.exp(self.w*np.repeat(np.log(delta), self.n))
+        else:
+            sqrt_w = None
+            F_beta = self.F(beta)
+            Y = self.Y
+            Z = self.Z
+            if self.std_flag == 0:
+                V = self.V
+            elif self.std_flag == 1:
+                V = np.repeat(delta[0], self.N)
+            elif self.std_flag == 2:
+                V = np.repeat(delta, self.n)
+
+        # factor the unperturbed varmat once; the constant real terms of
+        # the objective drop out of the imaginary parts below
+        R = Y - F_beta
+        varmat = utils.VarMat(V, Z, gamma, self.n,
+                              equal_groups=self._equal_groups)
+        c_factor = cho_factor(varmat.varMat(), lower=True,
+                              overwrite_a=True)
+
+        id_delta = range(self.k_beta + self.k_gamma, self.k)
+
+        g = np.zeros(self.k_total)
+        z = x + 0j
+
+        # beta block: D is fixed, batch all perturbed residual columns
+        # through one solve
+        if self.k_beta > 0:
+            R_mat = np.empty((self.N, self.k_beta), dtype=complex)
+            for i in range(self.k_beta):
+                z[i] += eps*1j
+                F_z = self.F(z[self.idx_beta])
+                if self.use_trimming:
+                    F_z = F_z*sqrt_w
+                R_mat[:, i] = Y - F_z
+                z[i] -= eps*1j
+            quad = np.einsum('ij,ij->j', R_mat, cho_solve(c_factor, R_mat))
+            g[self.idx_beta] = 0.5*np.imag(quad)/eps
+
+        # gamma block: blockwise rank-one updates of D through
+        # Sherman-Morrison, batched over all columns of Z
+        if self.k_gamma > 0:
+            inv_DU = cho_solve(c_factor, Z)
+            s = 1.0 + eps*1j*np.add.reduceat(Z*inv_DU, self.idx_split,
+                                             axis=0)
+            t = np.add.reduceat(R.reshape(self.N, 1)*inv_DU,
+                                self.idx_split, axis=0)
+            val = 0.5*np.sum(np.log(s), axis=0) -\
+                0.5*eps*1j*np.sum(t**2/s, axis=0)
+            g[self.idx_gamma] = np.imag(val)/eps
+
+        # delta block: perturbs the diagonal of D, rebuild from scratch
+        for i in id_delta:
+            z[i] += eps*1j
+            g[i] = np.imag(self.objective(z, use_ad=True))/eps
+            z[i] -= eps*1j
+
+        # priors for everything but delta, whose objective call above
+        # already includes them
+        for i in range(self.k_total):
+            if i in id_delta:
+                continue
+            z[i] += eps*1j
+            g[i] += np.imag(self._objectivePriors(z))/eps
+            z[i] -= eps*1j
 
         return g
 
+    def _trimParams(self):
+        """
+        return F(beta), (Z**2).dot(gamma) and the variance vector,
+        cached while beta, gamma and delta are unchanged so the
+        trimming objective and gradient share one evaluation
+        """
+        key = (self.beta.tobytes(), self.gamma.tobytes(),
+               self.delta.tobytes())
+        if self._trim_params.get('key') != key:
+            if self.std_flag == 0:
+                v = self.V
+            elif self.std_flag == 1:
+                v = np.repeat(self.delta[0], self.N)
+            elif self.std_flag == 2:
+                v = np.repeat(self.delta, self.n)
+            self._trim_params = {
+                'key': key,
+                'F_beta': self.F(self.beta),
+                'Z2_gamma': self.Z2.dot(self.gamma),
+                'v': v
+                }
+
+        return (self._trim_params['F_beta'],
+                self._trim_params['Z2_gamma'],
+                self._trim_params['v'])
+
     def objectiveTrimming(self, w):
-        t = (self.Z**2).dot(self.gamma)
-        r = self.Y - self.F(self.beta)
-        if self.std_flag == 0:
-            v = self.V
-        elif self.std_flag == 1:
-            v = np.repeat(self.delta[0], self.N)
-        elif self.std_flag == 2:
-            v = np.repeat(self.delta, self.n)
+        F_beta, t, v = self._trimParams()
+
+        if use_numba and not np.iscomplexobj(w):
+            val, _ = _trim_obj_grad_kernel(
+                np.ascontiguousarray(self.Y, dtype=np.float64),
+                np.ascontiguousarray(F_beta, dtype=np.float64),
+                np.ascontiguousarray(t, dtype=np.float64),
+                np.ascontiguousarray(v, dtype=np.float64),
+                np.ascontiguousarray(w, dtype=np.float64), False)
+
+            return val + 0.5*self.N*np.log(2.0*np.pi)
+
+        r = self.Y - F_beta
         d = v + t
 
         val = 0.5*np.sum(r**2*w/d)
@@ -434,24 +688,30 @@ class LimeTr:
 
     def gradientTrimming(self, w, use_ad=False, eps=1e-10):
         if use_ad:
-            # only use when testing
-            g = np.zeros(self.N)
-            z = w + 0j
-            for i in range(self.N):
-                z[i] += eps*1j
-                g[i] = self.objectiveTrimming(z).imag/eps
-                z[i] -= eps*1j
+            # only use when testing: stack all N perturbed weight vectors
+            # as rows and evaluate the objective terms in one broadcast
+            # instead of N objectiveTrimming calls
+            F_beta, t, v = self._trimParams()
+            r = self.Y - F_beta
+            d = v + t
+            W = w + eps*1j*np.eye(self.N)
+            vals = W.dot(0.5*r**2/d + 0.5*np.log(d))
+
+            return np.imag(vals)/eps
+
+        F_beta, t, v = self._trimParams()
+
+        if use_numba:
+            _, g = _trim_obj_grad_kernel(
+                np.ascontiguousarray(self.Y, dtype=np.float64),
+                np.ascontiguousarray(F_beta, dtype=np.float64),
+                np.ascontiguousarray(t, dtype=np.float64),
+                np.ascontiguousarray(v, dtype=np.float64),
+                np.ascontiguousarray(w, dtype=np.float64), True)
 
             return g
 
-        t = (self.Z**2).dot(self.gamma)
-        r = (self.Y - self.F(self.beta))**2
-        if self.std_flag == 0:
-            v = self.V
-        elif self.std_flag == 1:
-            v = np.repeat(self.delta[0], self.N)
-        elif self.std_flag == 2:
-            v = np.repeat(self.delta, self.n)
+        r = (self.Y - F_beta)**2
         d = v + t
 
         g = 0.5*r/d
@@ -529,6 +789,7 @@ class LimeTr:
 
             err = np.linalg.norm(w_new - self.w)/outer_step_size
             np.copyto(self.w, w_new)
+            self._w_ver += 1
 
             num_iter += 1
 
@@ -597,6 +858,9 @@ class LimeTr:
         E = np.random.randn(self.N)*S
 
         self.Y = self.F(beta_t) + ZU + E
+        self._trim_cache = {'w_ver': -1}
+        self._trim_params = {}
+        self._x_cache = {}
 
         if sim_prior:
             if self.use_gprior:
@@ -628,11 +892,11 @@ class LimeTr:
             Y = self.Y*sqrt_w
             Z = self.Z*sqrt_W
             if self.std_flag == 0:
-                V = self.V**self.w
+                V = np.exp(self.w*self._log_V)
             elif self.std_flag == 1:
-                V = np.repeat(delta[0], self.N)**self.w
+                V = np.exp(self.w*np.log(self.delta[0]))
             elif self.std_flag == 2:
-                V = np.repeat(delta, self.n)**self.w
+                V = np.exp(self.w*np.repeat(np.log(self.delta), self.n))
         else:
             F_beta = self.F(self.beta)
             JF_beta = self.JF(self.beta)
@@ -641,12 +905,13 @@ class LimeTr:
             if self.std_flag == 0:
                 V = self.V
             elif self.std_flag == 1:
-                V = np.repeat(delta[0], self.N)
+                V = np.repeat(self.delta[0], self.N)
             elif self.std_flag == 2:
-                V = np.repeat(delta, self.n)
+                V = np.repeat(self.delta, self.n)
 
 
-        D = utils.VarMat(V, Z, self.gamma, self.n)
+        D = utils.VarMat(V, Z, self.gamma, self.n,
+                         equal_groups=self._equal_groups)
 
         # compute the Hessian matrix
         hess = JF_beta.T.dot(D.invDot(JF_beta))
@@ -0,0 +1,71 @@
+# numba kernels for the hot paths
+import numpy as np
+
+try:
+    import numba
+    from numba import njit, prange
+    use_numba = not numba.config.DISABLE_JIT
+except ImportError:
+    use_numba = False
+
+
+if use_numba:
+    # explicit signatures compile (and disk-cache) the kernels eagerly
+    # at import, so no inference or warmup happens on the hot path
+    @njit('float64[::1](float64[:, :], float64[:, :], float64[::1],'
+          ' int64[::1], int64[::1])',
+          parallel=True, fastmath=True, cache=True, boundscheck=False)
+    def _g_gamma_kernel(Z, DZ, R, offs, lens):
+        """
+        fused per-group quadratic form for the gamma gradient,
+            g[k] = sum_i 0.5*sum_j z_ijk*Dz_ijk - 0.5*(sum_j Dz_ijk*r_ij)**2
+        accumulated in one pass over the data without temporary arrays;
+        Z and DZ arrive fortran-ordered so each column scan is
+        contiguous, but the signature stays any-layout because single
+        column arrays type as C-layout
+        """
+        m = lens.size
+        k = Z.shape[1]
+        g_group = np.zeros((m, k))
+        for i in prange(m):
+            for l in range(k):
+                s1 = 0.0
+                s2 = 0.0
+                for j in range(offs[i], offs[i] + lens[i]):
+                    dz = DZ[j, l]
+                    s1 += Z[j, l]*dz
+                    s2 += dz*R[j]
+                g_group[i, l] = 0.5*s1 - 0.5*s2*s2
+
+        g = np.zeros(k)
+        for i in range(m):
+            for l in range(k):
+                g[l] += g_group[i, l]
+
+        return g
+
+    @njit('Tuple((float64, float64[::1]))(float64[::1], float64[::1],'
+          ' float64[::1], float64[::1], float64[::1], boolean)',
+          fastmath=True, cache=True, boundscheck=False)
+    def _trim_obj_grad_kernel(Y, F_beta, Z2_gamma, V, w, want_grad):
+        """
+        single-pass trimming objective and gradient,
+            val = sum_i 0.5*r_i**2*w_i/d_i + 0.5*w_i*log(d_i)
+            g_i = 0.5*r_i**2/d_i + 0.5*log(d_i)
+        with d_i = v_i + (z_i**2).dot(gamma), without temporary arrays
+        """
+        N = Y.size
+        val = 0.0
+        if want_grad:
+            g = np.zeros(N)
+        else:
+            g = np.zeros(0)
+        for i in range(N):
+            r2 = (Y[i] - F_beta[i])**2
+            d = V[i] + Z2_gamma[i]
+            log_d = np.log(d)
+            val += 0.5*r2*w[i]/d + 0.5*w[i]*log_d
+            if want_grad:
+                g[i] = 0.5*r2/d + 0.5*log_d
+
+        return val, g
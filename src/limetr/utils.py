@@ -20,9 +20,11 @@ class VarMat:
     - invDiag
     - logDet
     """
-    def __init__(self, v, z, gamma, n):
+    def __init__(self, v, z, gamma, n, equal_groups=False):
         """
-        initialize the object
+        initialize the object, when equal_groups is True and all blocks
+        share one size the operations run on an (m, ni, ni) tensor
+        through batched lapack instead of the fortran kernels
         """
         # dimensions
         self.m = len(n)
@@ -43,8 +45,11 @@ class VarMat:
         self.n = np.array(n)
         self.gamma = gamma
 
+        self.equal_groups = equal_groups and np.all(self.n == self.n[0])
+
         # process the data until needed
         self.processed = False
+        self.batch = None
 
     def process(self):
         """
@@ -74,6 +79,57 @@ class VarMat:
 
         self.processed = True
 
+    def processBatch(self):
+        """
+        build the blocks as one (m, ni, ni) tensor and take its batched
+        cholesky, dispatching to lapack with one python entry
+        """
+        ni = int(self.n[0])
+        v3 = self.v.reshape(self.m, ni)
+        z3 = np.ascontiguousarray(self.z).reshape(self.m, ni, self.k)
+
+        D3 = np.matmul(z3*self.gamma, z3.transpose(0, 2, 1))
+        idx = np.arange(ni)
+        D3[:, idx, idx] += v3
+
+        chol = np.linalg.cholesky(D3)
+        self.batch = {
+            'ni': ni,
+            'D3': D3,
+            'log_det': 2.0*np.sum(np.log(chol[:, idx, idx]))
+            }
+
+    def _batchDot(self, mat3, x):
+        """
+        blockwise product of an (m, ni, ni) tensor with x
+        """
+        ni = self.batch['ni']
+        if x.ndim == 1:
+            x3 = x.reshape(self.m, ni)
+            return np.einsum('mij,mj->mi', mat3, x3).reshape(x.shape)
+        elif x.ndim == 2:
+            x3 = x.reshape(self.m, ni, x.shape[1])
+            return np.matmul(mat3, x3).reshape(x.shape)
+        else:
+            print('unsupported dim of x')
+            return None
+
+    def _batchSolve(self, x):
+        """
+        blockwise solve against the (m, ni, ni) tensor, avoiding the
+        explicit inverse for accuracy on ill-conditioned blocks
+        """
+        ni = self.batch['ni']
+        if x.ndim == 1:
+            x3 = x.reshape(self.m, ni, 1)
+        elif x.ndim == 2:
+            x3 = x.reshape(self.m, ni, x.shape[1])
+        else:
+            print('unsupported dim of x')
+            return None
+
+        return np.linalg.solve(self.batch['D3'], x3).reshape(x.shape)
+
     def varMat(self):
         """
         naive implementation of the varmat
@@ -114,6 +170,11 @@ class VarMat:
         """
         dot product with the covariate matrix
         """
+        if self.equal_groups:
+            if self.batch is None:
+                self.processBatch()
+            return self._batchDot(self.batch['D3'], x)
+
         if not self.processed:
             self.process()
 
@@ -134,6 +195,11 @@ class VarMat:
         """
         inverse dot product with the covariate matrix
         """
+        if self.equal_groups:
+            if self.batch is None:
+                self.processBatch()
+            return self._batchSolve(x)
+
         if not self.processed:
             self.process()
 
@@ -154,6 +220,12 @@ class VarMat:
         """
         return the diagonal of the matrix
         """
+        if self.equal_groups:
+            if self.batch is None:
+                self.processBatch()
+            idx = np.arange(self.batch['ni'])
+            return self.batch['D3'][:, idx, idx].reshape(self.N)
+
         if not self.processed:
             self.process()
 
@@ -169,6 +241,15 @@ class VarMat:
         """
         return the diagonal of the inverse covariate matrix
         """
+        if self.equal_groups:
+            if self.batch is None:
+                self.processBatch()
+            if 'inv_D3' not in self.batch:
+                # only the diagonal needs the explicit inverse
+                self.batch['inv_D3'] = np.linalg.inv(self.batch['D3'])
+            idx = np.arange(self.batch['ni'])
+            return self.batch['inv_D3'][:, idx, idx].reshape(self.N)
+
         if not self.processed:
             self.process()
 
@@ -183,6 +264,11 @@ class VarMat:
         """
         returns the log determinant of the covariate matrix
         """
+        if self.equal_groups:
+            if self.batch is None:
+                self.processBatch()
+            return self.batch['log_det']
+
         if not self.processed:
             self.process()
 
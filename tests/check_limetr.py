@@ -22,6 +22,7 @@ fun_list = [
     'limetr_gradient',
     'limetr_objectiveTrimming',
     'limetr_gradientTrimming',
+    'limetr_deepcopy',
     'limetr_lasso'
 ]
 
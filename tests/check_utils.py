@@ -32,6 +32,7 @@ fun_list = [
     'varmat_diag',
     'varmat_invDiag',
     'varmat_logDet',
+    'varmat_equal_groups',
     'projCappedSimplex'
 ]
 
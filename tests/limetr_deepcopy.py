@@ -0,0 +1,36 @@
+# test trimming weight update after deepcopy, used by sampleSoln
+
+
+def limetr_deepcopy():
+    import numpy as np
+    from copy import deepcopy
+    from limetr.__init__ import LimeTr
+
+    ok = True
+    tol = 1e-10
+    # setup test problem
+    # -------------------------------------------------------------------------
+    model = LimeTr.testProblem(use_trimming=True)
+    model_copy = deepcopy(model)
+
+    # update the weights the same way fitModel does
+    # -------------------------------------------------------------------------
+    w_new = np.random.rand(model.N)*0.5 + 0.5
+    for lt in (model, model_copy):
+        np.copyto(lt.w, w_new)
+        lt._w_ver += 1
+
+    # the copy must agree with the original at the same point
+    # -------------------------------------------------------------------------
+    x = np.random.randn(model.k)
+    x[model.idx_gamma] = 0.1
+
+    err = np.abs(model.objective(x) - model_copy.objective(x))
+    err += np.linalg.norm(model.gradient(x) - model_copy.gradient(x))
+    ok = ok and err < tol
+
+    if not ok:
+        print('err in deepcopy weight update')
+        print('err:', err)
+
+    return ok
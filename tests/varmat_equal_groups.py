@@ -0,0 +1,41 @@
+# check utils equal-size group batched path
+
+
+def varmat_equal_groups():
+    import numpy as np
+    from limetr.utils import VarMat
+
+    ok = True
+    tol = 1e-10
+    # setup problem
+    # -------------------------------------------------------------------------
+    n = [4]*5
+    N = sum(n)
+    k = 3
+
+    v = np.random.rand(N) + 1e-2
+    z = np.random.randn(N, k)
+    gamma = np.random.rand(k)
+
+    mat = VarMat(v, z, gamma, n, equal_groups=True)
+    D = mat.varMat()
+    inv_D = mat.invVarMat()
+
+    x = np.random.randn(N)
+    X = np.random.randn(N, 5)
+
+    err = np.linalg.norm(mat.dot(x) - D.dot(x))
+    err += np.linalg.norm(mat.dot(X) - D.dot(X))
+    err += np.linalg.norm(mat.invDot(x) - inv_D.dot(x))
+    err += np.linalg.norm(mat.invDot(X) - inv_D.dot(X))
+    err += np.linalg.norm(mat.diag() - np.diag(D))
+    err += np.linalg.norm(mat.invDiag() - np.diag(inv_D))
+    err += np.abs(mat.logDet() - np.log(np.linalg.det(D)))
+
+    ok = ok and err < tol
+
+    if not ok:
+        print('err in equal_groups')
+        print('err:', err)
+
+    return ok